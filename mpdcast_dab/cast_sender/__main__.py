@@ -5,6 +5,7 @@ import os
 import sys
 import asyncio
 import argparse
+import ipaddress
 import socket
 import ifaddr
 import time
@@ -12,20 +13,28 @@ import time
 import threading
 import traceback
 
+# optional: uvloop speeds up the hand over of the c lib callbacks to the event loop
+try:
+  import uvloop
+except ImportError:
+  uvloop = None
+
 if __name__ == '__main__':
   sys.path.append(os.path.dirname(__file__)  + '/../..')
 
 import mpdcast_dab.cast_sender.imageserver as imageserver
 from mpdcast_dab.cast_sender.mpd_caster import *
+from mpdcast_dab.cast_sender.cast_finder import CastFinder
 
 from mpdcast_dab.welle_python.dabserver import *
 
 def get_first_ipv4_address():
   for iface in ifaddr.get_adapters():
     for addr in iface.ips:
-      # Filter out link-local addresses.
+      # Filter out link-local and loopback addresses.
       if addr.is_IPv4:
-        if not (addr.ip.startswith('169.254.') or addr.ip == '127.0.0.1'):
+        ip = ipaddress.IPv4Address(addr.ip)
+        if not (ip.is_link_local or ip.is_loopback):
           return addr.ip
   return None
 
@@ -64,16 +73,18 @@ def main():
   cast_receiver_url = 'http://' + my_ip + ':' + str(WEB_PORT) + CAST_PATH + '/' + CAST_PAGE
     
   try:
-    loop = asyncio.new_event_loop()
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.create_task(setup_webserver(runner, WEB_PORT))
+    # a single finder for all casts, so the device is found again without a new network scan
+    cast_finder = CastFinder()
 
     # run the webserver in parallel to the cast task
     while True:
       # wait until we find the cast device in the network
-      mpd_caster = MpdCaster(mpdConfig, my_ip, image_request_handler, cast_receiver_url)
+      mpd_caster = MpdCaster(mpdConfig, my_ip, image_request_handler, cast_receiver_url, cast_finder)
       
-      mpd_caster.waitfor_and_register_device()
+      loop.run_until_complete(mpd_caster.waitfor_and_register_device())
       # run the cast (until chromecast disconnects)
       loop.run_until_complete(mpd_caster.cast_forever())
 
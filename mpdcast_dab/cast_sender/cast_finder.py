@@ -2,27 +2,54 @@ import asyncio
 import zeroconf
 import pychromecast
 
-class CastFinder(pychromecast.discovery.AbstractCastListener):  
-  def __init__(self, deviceName):
-    self._deviceName = deviceName
+class CastFinder(pychromecast.discovery.AbstractCastListener):
+  """
+  Finds cast devices by their name.
+  The browser keeps running between discoveries, so a device which was seen before
+  is found again without a new network scan
+  """
+  def __init__(self):
+    self.zconf = zeroconf.Zeroconf()
+    self._browser = pychromecast.discovery.CastBrowser(self, self.zconf, None)
+    self._browser_started = False
+    self._deviceName = None
+    self._loop = None
+    self._my_task = None
+    self.device = None
 
+  # called from the zeroconf thread
   def add_cast(self, uuid, _service):
-    if (self._deviceName == self._browser.services[uuid].friendly_name):
+    my_task = self._my_task
+    if my_task and self._deviceName == self._browser.services[uuid].friendly_name:
       self.device = self._browser.services[uuid]
-      self._my_task.set()
+      self._loop.call_soon_threadsafe(my_task.set)
 
   def remove_cast(self, uuid, _service, cast_info): pass
   def update_cast(self, uuid, _service): pass
-  
-  def doDiscovery (self):
-    asyncio.run(self._doDiscovery())
 
-  async def _doDiscovery (self):
-    self._browser = pychromecast.discovery.CastBrowser(self, zeroconf.Zeroconf(), None)
+  async def doDiscovery (self, deviceName):
+    self._deviceName = deviceName
+    self.device = None
+    # register for notifications before checking the known devices, so no device gets missed
+    self._loop = asyncio.get_running_loop()
     self._my_task = asyncio.Event()
-    self._browser.start_discovery()
-    await self._waitForDiscoveryEnd()
-    self._browser.stop_discovery()    
+    try:
+      self.device = self._known_device()
+      if self.device:
+        return
+      if not self._browser_started:
+        self._browser.start_discovery()
+        self._browser_started = True
+      await self._waitForDiscoveryEnd()
+    finally:
+      self._my_task = None
+
+  # returns the cast info of the device, in case the running browser already knows it
+  def _known_device(self):
+    for cast_info in list(self._browser.services.values()):
+      if cast_info.friendly_name == self._deviceName:
+        return cast_info
+    return None
 
   async def _waitForDiscoveryEnd(self):
     await self._my_task.wait()
@@ -2,7 +2,6 @@ import asyncio
 import re
 import tomllib
 import pychromecast
-import zeroconf
 import mpd.asyncio
 import argparse
 import time
@@ -13,7 +12,6 @@ logger = logging.getLogger(__name__)
 
 from mpdcast_dab.cast_sender.local_media_player import LocalMediaPlayerController, APP_LOCAL
 import mpdcast_dab.cast_sender.imageserver as imageserver
-from mpdcast_dab.cast_sender.cast_finder import CastFinder
 from mpdcast_dab.cast_sender.tvheadend_connector import TvheadendChannel
 from mpdcast_dab.cast_sender.dabserver_connector import DabserverStation
 
@@ -30,8 +28,9 @@ class MpdCaster(pychromecast.controllers.receiver.CastStatusListener,
   cast_forever returns as soon as the connection to the mpdclient instance is lost
   """
 
-  def __init__(self, config, my_ip, image_server, cast_receiver_url):
+  def __init__(self, config, my_ip, image_server, cast_receiver_url, cast_finder):
     self.image_server = image_server
+    self.cast_finder = cast_finder
     self.cast_receiver_url = cast_receiver_url
     self.default_image = 'https://www.musicpd.org/logo.png'
     self.my_ip = my_ip
@@ -51,15 +50,15 @@ class MpdCaster(pychromecast.controllers.receiver.CastStatusListener,
     self._media_event = asyncio.Event()
     self._media_status = None
   
-  def waitfor_and_register_device(self):
-    cast_finder = CastFinder(self.device_name)
-    cast_finder.doDiscovery()
-    self.chromecast = pychromecast.get_chromecast_from_cast_info(cast_finder.device, zeroconf.Zeroconf())
+  async def waitfor_and_register_device(self):
+    await self.cast_finder.doDiscovery(self.device_name)
+    self.chromecast = pychromecast.get_chromecast_from_cast_info(self.cast_finder.device, self.cast_finder.zconf)
 
-    self.chromecast.wait()
+    # connecting blocks, so keep it off the event loop, which serves the web requests meanwhile
+    await asyncio.get_running_loop().run_in_executor(None, self.chromecast.wait)
     if (self.chromecast.app_id != pychromecast.IDLE_APP_ID):
       self.chromecast.quit_app()
-      time.sleep(0.5)
+      await asyncio.sleep(0.5)
     self.controller = LocalMediaPlayerController(self.cast_receiver_url, False)
     self.chromecast.register_handler(self.controller)   # allows Chromecast to use Local Media Player app
     self.chromecast.register_connection_listener(self)  # this will call new_connection_status() => re-init from scratch
@@ -194,7 +193,7 @@ class MpdCaster(pychromecast.controllers.receiver.CastStatusListener,
       title = song_info['name']
 
     self.chromecast.wait()
-    logger.info('update:',  title, artist, image_url)
+    logger.info('update: %s %s %s', title, artist, image_url)
     self.controller.set_MusicTrackMediaMetadata(title, artist, image_url)
   
   def new_cast_status(self, status):
@@ -237,7 +236,7 @@ class MpdCaster(pychromecast.controllers.receiver.CastStatusListener,
           processed_mpd_state = current_mpd_state
 
         if current_mpd_song != processed_mpd_song:
-          logger.info('current_mpd_song:', current_mpd_song)
+          logger.info('current_mpd_song: %s', current_mpd_song)
           if current_mpd_song and current_mpd_state == "play":
             await self._handle_mpd_new_song(current_mpd_song)
             processed_mpd_song = current_mpd_song
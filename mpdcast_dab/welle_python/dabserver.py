@@ -1,151 +1,189 @@
 import asyncio
+import functools
+import struct
 from aiohttp import web
+from multidict import CIMultiDict, CIMultiDictProxy
 import logging
 logger = logging.getLogger(__name__)
 
 import mpdcast_dab.welle_python.welle_lib as welle_lib
 
 
+# names of the DAB band III channels known to the c lib: 5A to 12D, 13A to 13F
+VALID_CHANNELS = frozenset([str(number) + block for number in range(5, 13) for block in 'ABCD']
+                         + ['13' + block for block in 'ABCDEF'])
+
+# response headers for data which must not be cached by the client.
+# Built once as read-only multidicts, which aiohttp copies cheaply into each response
+NO_CACHE_HEADERS = CIMultiDictProxy(CIMultiDict({'Cache-Control': 'no-cache', 'Connection': 'Close'}))
+AUDIO_HEADERS    = CIMultiDictProxy(CIMultiDict({'Content-Type': 'audio/wav', 'Cache-Control': 'no-cache', 'Connection': 'Close'}))
+
+
+# is_float should only be true if the audio data is in 32-bit floating-point format.
+# The header only depends on the stream format, so it is built once per format.
+@functools.lru_cache(maxsize=8)
+def wav_header(is_float, channels, bit_rate, sample_rate):
+  return struct.pack('<4sI4s4sIHHIIHH4sI',
+                     b'RIFF',                                    # Chunk ID
+                     0,                                          # Chunk size: stream -> set to zero
+                     b'WAVE',                                    # Format
+                     b'fmt ',                                    # Sub-chunk 1 ID
+                     16,                                         # Sub-chunk 1 size
+                     3 if is_float else 1,                       # Audio format (floating point (3) or PCM (1))
+                     channels,                                   # Channels
+                     sample_rate,                                # Sample rate
+                     sample_rate * channels * (bit_rate // 8),   # Bytes rate
+                     channels * (bit_rate // 8),                 # Block align
+                     bit_rate,                                   # Bits per sample
+                     b'data',                                    # Sub-chunk 2 ID
+                     0)                                          # Sub-chunk 2 size: stream -> set to zero
+
+
 class DabServer():
-  
+  # minimum duration of audio (in seconds) sent to the client with each write
+  AUDIO_WRITE_INTERVAL = 0.08
+
   def __init__(self, my_ip, port):
     self.my_ip = my_ip
     self.port = port
     self.radio_controller = welle_lib.RadioController()
     self.radio_controller.init()
-    self.handlers = {}
 
   def get_routes(self):
-    return [web.get(r'/stream/{channel:[0-9]{1,2}[A-Z]}/{program:.+}', self.get_audio),
-            web.get(r'/image/current/{channel:[0-9]{1,2}[A-Z]}/{program:.+}', self.get_current_image),
-            web.get(r'/label/current/{channel:[0-9]{1,2}[A-Z]}/{program:.+}', self.get_current_label),
-            web.get(r'/image/next/{channel:[0-9]{1,2}[A-Z]}/{program:.+}', self.get_next_image),
-            web.get(r'/label/next/{channel:[0-9]{1,2}[A-Z]}/{program:.+}', self.get_next_label)]
+    # the channel format is validated by the handlers, see _get_channel_and_program
+    return [web.get(r'/stream/{channel}/{program:.+}', self.get_audio),
+            web.get(r'/image/current/{channel}/{program:.+}', self.get_current_image),
+            web.get(r'/label/current/{channel}/{program:.+}', self.get_current_label),
+            web.get(r'/image/next/{channel}/{program:.+}', self.get_next_image),
+            web.get(r'/label/next/{channel}/{program:.+}', self.get_next_label)]
+
+  def _get_channel_and_program(self, request):
+    match_info = request.match_info
+    channel = match_info['channel']
+    if channel not in VALID_CHANNELS:
+      raise web.HTTPNotFound()
+    return channel, match_info['program']
+
+  # checks the If-None-Match header of the request against the digest of the current data
+  @staticmethod
+  def _not_modified(request, digest):
+    etags = request.if_none_match
+    # weak comparison, as defined for If-None-Match
+    return bool(etags) and any(etag.value in (digest, '*') for etag in etags)
 
   async def stop(self):
     await self.radio_controller.finalize()
 
 
-  # is_float should only be true if the audio data is in 32-bit floating-point format.
-  def wav_header(self, is_float, channels, bit_rate, sample_rate):
-    bo = 'little'; enc = 'ascii'
-          # RIFF header
-    return (bytes('RIFF', enc)                                         # Chunk ID
-          + (0).to_bytes(4, bo)                                        # Chunk size: stream -> set to zero
-          + bytes('WAVE', enc)                                         # Format
-
-          # Sub-chunk 1                                                
-          + bytes('fmt ', enc)                                         # Sub-chunk 1 ID
-          + (16).to_bytes(4, bo)                                       # Sub-chunk 1 size
-          + (3 if is_float else 1).to_bytes(2, bo)                     # Audio format (floating point (3) or PCM (1))
-          + channels.to_bytes(2, bo)                                   # Channels
-          + sample_rate.to_bytes(4, bo)                                # Sample rate
-          + (sample_rate * channels * (bit_rate // 8)).to_bytes(4, bo) # Bytes rate
-          + (channels * (bit_rate // 8)).to_bytes(2, bo)               # Block align
-          + bit_rate.to_bytes(2, bo)                                   # Bits per sample
-
-          # Sub-chunk 2                                            
-          + bytes('data', enc)                                         # Sub-chunk 2 ID
-          + (0).to_bytes(4, bo))                                       # Sub-chunk 2 size: stream -> set to zero
-
   async def get_next_image(self, request):
-    channel = request.match_info['channel']
-    program = request.match_info['program'] 
-    logger.debug('get_next_image', channel, program)
-    if program in self.handlers:
-      try:
-        image = await self.handlers[program].new_picture()
-        return web.Response(body = image['data'],
-                            content_type = image['type'],
-                            headers={'Cache-Control': 'no-cache', 'Connection': 'Close'})
-      except welle_lib.UnsubscribedError:
-        raise web.HTTPBadRequest()
-    else:
+    channel, program = self._get_channel_and_program(request)
+    logger.debug('get_next_image %s %s', channel, program)
+    handler = self.radio_controller.get_programme_handler(program)
+    if not handler:
       raise web.HTTPNotFound()
+    try:
+      image = await handler.new_picture()
+    except welle_lib.UnsubscribedError:
+      raise web.HTTPBadRequest()
+    return web.Response(body = image.data,
+                        content_type = image.type,
+                        headers=NO_CACHE_HEADERS)
 
 
   async def get_next_label(self, request):
-    channel = request.match_info['channel']
-    program = request.match_info['program'] 
-    logger.debug('get_next_label', channel, program)
-    if program in self.handlers:
-      try:
-        label = await self.handlers[program].new_label()
-        return web.Response(text=label,
-                            headers={'Cache-Control': 'no-cache', 'Connection': 'Close'})
-      except welle_lib.UnsubscribedError:
-        raise web.HTTPBadRequest()
-    else:
+    channel, program = self._get_channel_and_program(request)
+    logger.debug('get_next_label %s %s', channel, program)
+    handler = self.radio_controller.get_programme_handler(program)
+    if not handler:
       raise web.HTTPNotFound()
+    try:
+      label = await handler.new_label()
+    except welle_lib.UnsubscribedError:
+      raise web.HTTPBadRequest()
+    return web.Response(text=label, headers=NO_CACHE_HEADERS)
 
 
   async def get_current_image(self, request):
-    channel = request.match_info['channel']
-    program = request.match_info['program']  
-    logger.debug('get_current_image', channel, program)
-    if (program in self.handlers and
-        len(self.handlers[program].picture['data']) > 0):
-        return web.Response(body = self.handlers[program].picture['data'],
-                            content_type = self.handlers[program].picture['type'],
-                            headers={'Cache-Control': 'no-cache', 'Connection': 'Close'})
-    else:
+    channel, program = self._get_channel_and_program(request)
+    logger.debug('get_current_image %s %s', channel, program)
+    handler = self.radio_controller.get_programme_handler(program)
+    picture = handler.picture if handler else None
+    if not picture or not picture.data:
       raise web.HTTPNotFound()
+    headers = {'ETag': '"' + picture.digest + '"', 'Cache-Control': 'max-age=1', 'Connection': 'Close'}
+    if DabServer._not_modified(request, picture.digest):
+      return web.Response(status=304, headers=headers)
+    return web.Response(body = picture.data,
+                        content_type = picture.type,
+                        headers=headers)
 
 
   async def get_current_label(self, request):
-    channel = request.match_info['channel']
-    program = request.match_info['program']  
-    logger.debug('get_current_label', channel, program)
-    if program in self.handlers:
-      return web.Response(text=self.handlers[program].label,
-                          headers={'Cache-Control': 'no-cache', 'Connection': 'Close'})
-    else:
+    channel, program = self._get_channel_and_program(request)
+    logger.debug('get_current_label %s %s', channel, program)
+    handler = self.radio_controller.get_programme_handler(program)
+    if not handler:
       raise web.HTTPNotFound()
-
-
-  async def get_audio(self, request, retry = True):
-    channel = request.match_info['channel']
-    program = request.match_info['program']  
-    if program.startswith('cover.'):
+    # read the digest first, see WavProgrammeHandler.onNewDynamicLabel
+    digest = handler.label_digest
+    label = handler.label
+    headers = {'ETag': '"' + digest + '"', 'Cache-Control': 'max-age=1', 'Connection': 'Close'}
+    if DabServer._not_modified(request, digest):
+      return web.Response(status=304, headers=headers)
+    return web.Response(text=label, headers=headers)
+
+
+  async def get_audio(self, request):
+    # cover art requests never need the device, so reject them first
+    if request.match_info['program'].startswith('cover.'):
       raise web.HTTPNotFound()
-    logger.info('new audio request for', program)
+    channel, program = self._get_channel_and_program(request)
+    logger.info('new audio request for %s %s', channel, program)
     
 
-    handler = await self.radio_controller.subscribe_program(channel, program)
-    if not handler:
-      # The device is busy with streaming another channel
-      if retry:
+    for attempt in range(2):
+      handler = await self.radio_controller.subscribe_program(channel, program)
+      if handler:
+        break
+      # The device is busy with streaming another channel. Retry once after a short delay
+      if attempt == 0:
         await asyncio.sleep(0.5)
-        await self.get_audio(request, False)
-      else:
-        raise web.HTTPServiceUnavailable()
-    
+    else:
+      raise web.HTTPServiceUnavailable()
+
     # from here on, the device sends us the audio stream
     # send it via stream response until the user cancels it
-    self.handlers[program] = handler
     try:
       response = web.StreamResponse(
         status=200,
         reason='OK',
-        headers={'Content-Type': 'audio/wav','Cache-Control': 'no-cache', 'Connection': 'Close'})
+        headers=AUDIO_HEADERS)
       await response.prepare(request)
 
-      # prepend the wav header to the initial response
-      next_audio_frame, audio = await handler.new_audio()
-      header = self.wav_header(False, 2, 16, handler.sample_rate)
-      await response.write(header + audio)
+      # send the wav header together with the initial audio in a single write
+      next_audio_frame, frames = await handler.new_audio_frames()
+      frames.insert(0, wav_header(False, 2, 16, handler.sample_rate))
+      await response.write(b''.join(frames))
 
+      # collect several frames per write to reduce the number of send calls
+      # 16 bit stereo audio: 4 bytes per sample
+      min_write_size = int(handler.sample_rate * 4 * DabServer.AUDIO_WRITE_INTERVAL)
+      audio_buffer = []
+      buffered_size = 0
       while True:
-        next_audio_frame, audio = await handler.new_audio(next_audio_frame)
-        await response.write(audio)
-#        await asyncio.sleep(0.1)  # consider using this for performance gains
+        # take the frames as they are, so they get copied only once by the join below
+        next_audio_frame, frames = await handler.new_audio_frames(next_audio_frame)
+        audio_buffer += frames
+        buffered_size += sum(map(len, frames))
+        if buffered_size >= min_write_size:
+          await response.write(b''.join(audio_buffer))
+          audio_buffer.clear()
+          buffered_size = 0
     except (asyncio.exceptions.CancelledError,
             asyncio.exceptions.TimeoutError,
             ConnectionResetError):
       # user cancelled the stream, so unsubscribe
       await self.radio_controller.unsubscribe_program(program)
-      if not self.radio_controller.is_playing(program):
-        del self.handlers[program]
       return response
     except welle_lib.UnsubscribedError:
       return response
@@ -1,64 +1,115 @@
 import asyncio
 import datetime
+import hashlib
 import logging
+import time
 logger = logging.getLogger(__name__)
 
 import mpdcast_dab.welle_python.libwelle_py as c_lib
 
+# exceptions raised when a user cancels a request
+CANCEL_OR_RESET = (asyncio.CancelledError, ConnectionResetError)
+
 class UnsubscribedError(Exception):
   pass
 
+class MotPicture():
+  # slideshow picture of a program, as received by MOT
+  __slots__ = ('type', 'data', 'name', 'digest')
+
+  def __init__(self, mime_type, data, name, digest):
+    self.type   = mime_type
+    self.data   = data
+    self.name   = name
+    self.digest = digest
+
 class WavProgrammeHandler():
-  BUFFER_SIZE = 10
+  """
+  Receives the decoded data of a subscribed program from the c lib and forwards it to user applications.
+  The c lib callbacks hand their data over to the event loop, so producer and consumers
+  of the audio buffer run on the same loop and the buffer needs no lock.
+  """
+
+  __slots__ = ('_controller', 'sId', '_subscribers', '_next_frame', '_audio_data',
+               '_pending_frames', '_pending_audio_size',
+               'sample_rate', 'picture', 'label', 'label_digest',
+               '_audio_waiters', '_picture_waiters', '_label_waiters',
+               '_caller_loop', '_delete_in_progress')
+
+  # ring buffer size for audio frames. Must be a power of two, so the index wraps with a bit mask
+  BUFFER_SIZE = 16
+  # audio is handed over to the event loop in batches of at least this duration (in seconds)
+  AUDIO_BATCH_INTERVAL = 0.05
 
   def __init__(self, controller, sId):
     self._controller = controller
     self.sId = sId
     self._subscribers = 0
 
+    # number of the next audio frame, counting all frames received so far.
+    # A frame is stored in the ring slot given by its number modulo BUFFER_SIZE
     self._next_frame = 0
     self._audio_data = [b''] * WavProgrammeHandler.BUFFER_SIZE
-    self._audio_data_lock = asyncio.Lock()
+    # frames received by the c lib thread which are not yet handed over to the event loop
+    self._pending_frames = []
+    self._pending_audio_size = 0
 
     # properties for most recent data. 
     # Can be used directly by user applications to get the most recent data
+    self.sample_rate = 0
     self.picture = None
     self.label   = ''
+    # allows http clients to revalidate the label without transferring it again
+    self.label_digest = WavProgrammeHandler._digest(b'')
     
-    # internal update notification events
-    self._audio_event      = asyncio.Event()
-    self._picture_event    = asyncio.Event()
-    self._label_event      = asyncio.Event()
+    # futures of the consumers waiting for new data
+    self._audio_waiters   = []
+    self._picture_waiters = []
+    self._label_waiters   = []
     
-    self._caller_loop = asyncio.get_running_loop()
+    # the controller is bound to a single event loop, which it caches on first use
+    self._caller_loop = controller._caller_loop
     self._delete_in_progress = False
 
   # notification routines for user applications
   async def new_audio(self, start_frame=0):
-    if start_frame == self._next_frame:
-      await self._audio_event.wait()
-      if self._delete_in_progress:
-        raise UnsubscribedError
-    async with self._audio_data_lock:
-      if start_frame < self._next_frame:
-        ret_list = self._audio_data[start_frame:self._next_frame]
-      else:
-        ret_list = self._audio_data[start_frame:] + self._audio_data[:self._next_frame]
-      audio_out = b''.join(ret_list)
-      return self._next_frame, audio_out
+    next_frame, frames = await self.new_audio_frames(start_frame)
+    return next_frame, b''.join(frames)
+
+  # same as new_audio, but returns the list of frames. Allows consumers to join them with own data
+  async def new_audio_frames(self, start_frame=0):
+    while start_frame == self._next_frame and not self._delete_in_progress:
+      await self._wait(self._audio_waiters)
+    if self._delete_in_progress:
+      raise UnsubscribedError
+    # no await from here on, so the buffer cannot change while it is read
+    next_frame = self._next_frame
+    mask = WavProgrammeHandler.BUFFER_SIZE-1
+    if start_frame+1 == next_frame:
+      # common case of a consumer keeping up: return the single new frame
+      return next_frame, [self._audio_data[start_frame & mask]]
+    # a consumer which fell behind continues with the oldest frame still in the buffer
+    start_frame = max(start_frame, next_frame - WavProgrammeHandler.BUFFER_SIZE)
+    first_slot, end_slot = start_frame & mask, next_frame & mask
+    if first_slot < end_slot:
+      return next_frame, self._audio_data[first_slot:end_slot]
+    else:
+      return next_frame, self._audio_data[first_slot:] + self._audio_data[:end_slot]
 
   async def new_picture(self):
     logger.debug('waiting for new picture')
-    await self._picture_event.wait()
+    if not self._delete_in_progress:
+      await self._wait(self._picture_waiters)
     if self._delete_in_progress:
       raise UnsubscribedError
     else:
-      logger.debug('forwarding new picture of type', self.picture['type'])
+      logger.debug('forwarding new picture of type %s', self.picture.type)
       return self.picture
 
   async def new_label(self):
     logger.debug('waiting for new label')
-    await self._label_event.wait()
+    if not self._delete_in_progress:
+      await self._wait(self._label_waiters)
     if self._delete_in_progress:
       raise UnsubscribedError
     else:
@@ -67,24 +118,49 @@ class WavProgrammeHandler():
 
   def _release_waiters(self):
     self._delete_in_progress = True
-    self._audio_event.set()
-    self._picture_event.set()
-    self._label_event.set()
+    for waiters in (self._audio_waiters, self._picture_waiters, self._label_waiters):
+      WavProgrammeHandler._wake(waiters)
+
+  async def _wait(self, waiters):
+    waiter = self._caller_loop.create_future()
+    waiters.append(waiter)
+    await waiter
+
+  @staticmethod
+  def _digest(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+  @staticmethod
+  def _wake(waiters):
+    for waiter in waiters:
+      # skip the waiters of cancelled consumers
+      if not waiter.done():
+        waiter.set_result(None)
+    waiters.clear()
 
   def onFrameErrors(self, frameErrors):
     pass
 
   def onNewAudio(self, audio_data, sample_rate, mode):
     self.sample_rate = sample_rate
-    asyncio.run_coroutine_threadsafe(self.buffer_audio(audio_data), self._caller_loop)
-
-  async def buffer_audio(self, audio_data):
-    async with self._audio_data_lock:
-      self._audio_data[self._next_frame] = audio_data
-      self._next_frame = (self._next_frame+1) % WavProgrammeHandler.BUFFER_SIZE
-    if not self._delete_in_progress:
-      self._audio_event.set()
-      self._audio_event.clear()
+    # batch small frames into fewer event loop wake ups, but hand them over before they overrun the ring buffer.
+    # 16 bit stereo audio: 4 bytes per sample
+    self._pending_frames.append(audio_data)
+    self._pending_audio_size += len(audio_data)
+    if (self._pending_audio_size >= sample_rate * 4 * WavProgrammeHandler.AUDIO_BATCH_INTERVAL
+        or len(self._pending_frames) >= WavProgrammeHandler.BUFFER_SIZE // 2):
+      frames = self._pending_frames
+      self._pending_frames = []
+      self._pending_audio_size = 0
+      # hand the frames over to the event loop as a plain callback, without a task per batch
+      self._caller_loop.call_soon_threadsafe(self._buffer_audio, frames)
+
+  def _buffer_audio(self, frames):
+    mask = WavProgrammeHandler.BUFFER_SIZE-1
+    for audio_data in frames:
+      self._audio_data[self._next_frame & mask] = audio_data
+      self._next_frame += 1
+    WavProgrammeHandler._wake(self._audio_waiters)
 
   def onRsErrors(self, uncorrectedErrors, numCorrectedErrors):
     pass
@@ -93,17 +169,23 @@ class WavProgrammeHandler():
     pass
 
   def onNewDynamicLabel(self, label):
+    # stations repeat the same label many times. Only notify consumers about changes
+    if label == self.label:
+      return
+    # set the label before its digest. Readers on the event loop take the digest first,
+    # so they might send the new label with the old digest, but never an old label with the new digest
     self.label = label
-    asyncio.run_coroutine_threadsafe(self._set_event(self._label_event), self._caller_loop)
-    
-  async def _set_event(self, event):
-    if not self._delete_in_progress:
-      event.set()
-      event.clear()
+    self.label_digest = WavProgrammeHandler._digest(label.encode())
+    self._caller_loop.call_soon_threadsafe(WavProgrammeHandler._wake, self._label_waiters)
 
   def onMOT(self, data, mime_type, name):
-    self.picture = {'type': mime_type, 'data': data, 'name': name}
-    asyncio.run_coroutine_threadsafe(self._set_event(self._picture_event), self._caller_loop)
+    # the digest allows http clients to revalidate the picture without transferring it again
+    digest = WavProgrammeHandler._digest(data)
+    # slideshows repeat their pictures. Only notify consumers about changes
+    if self.picture and self.picture.name == name and self.picture.digest == digest:
+      return
+    self.picture = MotPicture(mime_type, data, name, digest)
+    self._caller_loop.call_soon_threadsafe(WavProgrammeHandler._wake, self._picture_waiters)
 
   def onPADLengthError(self, announced_xpad_len, xpad_len):
     pass
@@ -111,20 +193,48 @@ class WavProgrammeHandler():
 
 class RadioController():
   PROGRAM_DISCOVERY_TIMEOUT = 10
+  # maximum time between two checks for the name of a detected service
+  SERVICE_NAME_RECHECK_INTERVAL = 0.5
+  # time to keep the channel tuned after the last unsubscription
+  CHANNEL_RESET_DELAY = 1
+  # time the device needs after the release of a channel, before it can get tuned again
+  DEVICE_SETTLE_TIME = 1
+
+  # state of the currently tuned channel
+  class ChannelData():
+    __slots__ = ('name', 'ensemble_label', 'datetime')
+
+    def __init__(self):
+      self.name           = ''
+      self.ensemble_label = None
+      self.datetime       = None
   
   def __init__(self, gain=-1):
 #    test = c_lib.RadioController()
 #    test.WPH_Test()
     self.gain = gain    
     self.programs            = {}
+    self._name_to_sid        = {}
     self._programme_handlers = {}
 
-    self._current_channel = ""
-    self.ensemble_label   = None
+    self._channel = RadioController.ChannelData()
 
     # lock to prevent parallel initialization from multiple users
     self._subscription_lock = asyncio.Lock()
 
+    # notification about newly detected services, set from the c lib thread
+    self._service_event = asyncio.Event()
+    self._caller_loop   = None
+
+    # task to release the channel once it is no longer in use
+    self._channel_release = None
+    # executor future of a device tuning which was cancelled and might still be in progress
+    self._tuning = None
+    # task releasing the device, which completes even if the subscriber driving it gets cancelled
+    self._device_release = None
+    # monotonic time of the last channel release
+    self._channel_released_at = None
+
     
   # Note: This method must not be called by __init__, as self cannot yet be used at this point
   def init(self, device_name = "auto"):
@@ -144,17 +254,36 @@ class RadioController():
     pass
     
   def onServiceDetected(self, sId):
-    if not sId in self.programs:
-      self.programs[sId] = None
+    # called from the c lib thread. Register the service from within the event loop
+    self._caller_loop.call_soon_threadsafe(self._add_service, sId)
+
+  def _add_service(self, sId):
+    # ignore late notifications for a channel which was already released
+    if not self._channel.name or sId in self.programs:
+      return
+    # try to resolve the name right away. If it is not yet known, _get_program_id will retry
+    name = c_lib.get_service_names(self.c_impl, [sId])[0].rstrip()
+    self.programs[sId] = name
+    if name:
+      self._name_to_sid[name] = sId
+    self._service_event.set()
     
   def onNewEnsemble(self, eId):
     pass
     
   def onSetEnsembleLabel(self, label):
-    self.ensemble_label = label
+    # called from the c lib thread. Labels are decoded together, so service names might now be known as well
+    self._caller_loop.call_soon_threadsafe(self._set_ensemble_label, label)
+
+  def _set_ensemble_label(self, label):
+    if not self._channel.name:
+      return
+    self._channel.ensemble_label = label
+    if self._resolve_service_names():
+      self._service_event.set()
 
   def onDateTimeUpdate(self, timestamp):
-    self.datetime = datetime.datetime.fromtimestamp(timestamp)
+    self._channel.datetime = datetime.datetime.fromtimestamp(timestamp)
 
   def onFIBDecodeSuccess(self, crcCheckOk, fib):
     pass
@@ -163,126 +292,222 @@ class RadioController():
     pass
     
   def _get_program_id(self, program_name):
-    for sId in self.programs:
-      if not self.programs[sId] or len(self.programs[sId]) == 0:
-        self.programs[sId] = c_lib.get_service_name(self.c_impl, sId).rstrip()
-      if self.programs[sId] == program_name:
-        return sId
-    # Not found
-    return None
+    program_pid = self._name_to_sid.get(program_name)
+    if program_pid:
+      return program_pid
+    self._resolve_service_names()
+    # None if not found
+    return self._name_to_sid.get(program_name)
+
+  # resolves the names of all services which are not yet known, using a single c lib call.
+  # returns True if any new name was found
+  def _resolve_service_names(self):
+    unresolved = [sId for sId, name in self.programs.items() if not name]
+    if not unresolved:
+      return False
+    found = False
+    names = c_lib.get_service_names(self.c_impl, unresolved)
+    for sId, name in zip(unresolved, names):
+      name = name.rstrip()
+      if name:
+        self.programs[sId] = name
+        self._name_to_sid[name] = sId
+        found = True
+    return found
 
 
   async def _wait_for_channel(self, program_name):
-    # initial check, as we might already have an active subscription for the program
-    program_pid = self._get_program_id(program_name)
-    if program_pid:
-      return program_pid
-    
-    # wait the defined time for the program discovery 
-    # and check every 0.5 seconds if it was succesful
-    for _ in range(2 * RadioController.PROGRAM_DISCOVERY_TIMEOUT):
-      await asyncio.sleep(0.5)
+    # wait the defined time for the program discovery.
+    # The first check might already succeed in case of an active subscription for the program
+    deadline = self._caller_loop.time() + RadioController.PROGRAM_DISCOVERY_TIMEOUT
+    recheck_interval = RadioController.SERVICE_NAME_RECHECK_INTERVAL
+    while True:
+      self._service_event.clear()
       program_pid = self._get_program_id(program_name)
       if program_pid:
         return program_pid
-    # Not found
-    return None
+      remaining = deadline - self._caller_loop.time()
+      if remaining <= 0:
+        # Not found
+        return None
+      # wake up as soon as a new service gets detected, but check regularly,
+      # as the name of an already detected service might become available later on
+      try:
+        async with asyncio.timeout(min(recheck_interval, remaining)):
+          await self._service_event.wait()
+      except TimeoutError:
+        pass
       
 
   # returns handler in case the subscription suceeded, otherwise None
   async def subscribe_program(self, channel, program_name):
+    if not self._caller_loop:
+      self._caller_loop = asyncio.get_running_loop()
+
+    # fast path for a program with an active subscription: no need to wait for other subscribers.
+    # There is no await until the counter is increased, so the lock is not required here
+    if self._channel.name == channel:
+      programme_handler = self.get_programme_handler(program_name)
+      if programme_handler:
+        programme_handler._subscribers += 1
+        return programme_handler
+
     async with self._subscription_lock:
+      if self._device_release:
+        # a cancelled subscriber left a device release behind
+        await self._reset_channel()
+      if self._channel_release:
+        # the release waits for this lock before it touches the channel, so it can still be cancelled
+        self._channel_release.cancel()
+        self._channel_release = None
+        # keep using the channel if it is still tuned from a previous subscription.
+        # Otherwise release it right away. The c lib completes unsubscriptions before it returns,
+        # so there is no need to wait for the release delay
+        if self._channel.name != channel or self._tuning:
+          await self._reset_channel()
+
+      current_channel = self._channel.name
       # Block actions in case there is another channel active
-      if self._current_channel and self._current_channel != channel:
+      if current_channel and current_channel != channel:
         return None
 
       # If There is no active channel, tune the device to the channel
-      if not self._current_channel:
-        tune_okay = c_lib.set_channel(self.c_impl, channel)
-        if tune_okay:
-          self._current_channel = channel
-        else:
+      if not current_channel:
+        if self._channel_released_at is not None:
+          # deliberately timed: give the device time to settle before it gets tuned again.
+          # The c lib does not report when the device is idle. Other intended timed waits are the
+          # delayed channel release and the service name recheck in _wait_for_channel
+          await asyncio.sleep(self._channel_released_at + RadioController.DEVICE_SETTLE_TIME - time.monotonic())
+        # tuning blocks until the device is ready, so run it outside of the event loop.
+        # Set the channel beforehand, to accept the services detected while tuning
+        self._channel.name = channel
+        tuning = self._caller_loop.run_in_executor(None, c_lib.set_channel, self.c_impl, channel)
+        try:
+          tune_okay = await asyncio.shield(tuning)
+        except CANCEL_OR_RESET:
+          # the device gets tuned regardless of the cancellation. Release it again once done.
+          # The release runs as separate task, so a repeated cancellation cannot skip it
+          self._tuning = tuning
+          self._schedule_channel_release()
+          raise
+        if not tune_okay:
+          self._channel.name = ''
           print("could not start device, fatal")
           return None
 
-      # Wait for the selected program to appear in the channel
+      programme_handler = None
       try:
+        # Wait for the selected program to appear in the channel
         program_pid = await self._wait_for_channel(program_name)
-
-      # Because the user might cancel the subscription request while waiting,
-      # we need to check for CancelledError and ConnectionResetError.
-      # In these cases, we need to reset the c lib to get back to an idle state. 
-      except (asyncio.exceptions.CancelledError,
-            ConnectionResetError):
-        if not self._programme_handlers:
-          await self._reset()
-				# re-throw the exception so the caller can also do its cleanup
-        raise
-
-      # The program is not part of the channel
-      if not program_pid:
-        if not self._programme_handlers:
-          await self._reset()
-        return None
-       
-      # the program exists in the channel. Check if there is already an active subscription
-      if program_pid in self._programme_handlers:
-        programme_handler = self._programme_handlers[program_pid]
-      else:
-        # First time subscription to the channel. Set up the handler and register it.
-        programme_handler = WavProgrammeHandler(self, program_pid)
-        self._programme_handlers[program_pid] = programme_handler
-        if not c_lib.subscribe_program(self.c_impl, programme_handler, program_pid):
-          if not self._programme_handlers:
-            await self._reset()
+        # The program is not part of the channel
+        if not program_pid:
           return None
 
+        # the program exists in the channel. Check if there is already an active subscription
+        programme_handler = self._programme_handlers.get(program_pid)
+        if not programme_handler:
+          # First time subscription to the program. Set up the handler and register it once the c lib accepted it.
+          programme_handler = WavProgrammeHandler(self, program_pid)
+          if not c_lib.subscribe_program(self.c_impl, programme_handler, program_pid):
+            programme_handler = None
+            return None
+          self._programme_handlers[program_pid] = programme_handler
+      finally:
+        # Whenever no program is left subscribed, reset the c lib to get back to an idle state.
+        # Because the user might cancel the subscription request while waiting, this also runs
+        # for CancelledError and ConnectionResetError, which get re-thrown afterwards
+        if not programme_handler and not self._programme_handlers:
+          self._schedule_channel_release()
+
       # increase the counter of active subscriptions for the selected program
       programme_handler._subscribers += 1
-      logger.debug('subscribers:', programme_handler._subscribers)
+      logger.debug('subscribers: %d', programme_handler._subscribers)
       return programme_handler
 
 
   async def unsubscribe_program(self, program_name):
+    # nothing to do without an active subscription, so do not wait for the lock
+    if not self.get_programme_handler(program_name):
+      return
     async with self._subscription_lock:
-      program_pid = self._get_program_id(program_name)
+      # subscribed programs are always indexed, so no need to ask the c lib for names
+      program_pid = self._name_to_sid.get(program_name)
       if program_pid:
         await self._unsubscribe(program_pid)
 
 
-  def is_playing(self, program_name):
-    program_pid = self._get_program_id(program_name)
-    if not program_pid:
-      return False
-    else:
-      return program_pid in self._programme_handlers
+  # returns the handler of the active subscription for the program, otherwise None
+  def get_programme_handler(self, program_name):
+    return self._programme_handlers.get(self._name_to_sid.get(program_name))
 
 
   async def _unsubscribe(self, program_pid):
-    programme_handler = self._programme_handlers[program_pid]
+    programme_handler = self._programme_handlers.get(program_pid)
     if not programme_handler:
       return
 
     programme_handler._subscribers -= 1
-    logger.debug('subscribers:', programme_handler._subscribers)
+    logger.debug('subscribers: %d', programme_handler._subscribers)
     if programme_handler._subscribers == 0:
-      c_lib.unsubscribe_program(self.c_impl, program_pid)
-      self._programme_handlers[program_pid]._release_waiters()
+      # unregister the handler first, so the subscription fast path cannot pick it up while waiting below
       del self._programme_handlers[program_pid]
-      await asyncio.sleep(1)
-      if not self._programme_handlers:
-        await self._reset()
-
-  async def _reset(self):
-    c_lib.set_channel(self.c_impl, "")
-    self._current_channel = None
-    self.programs.clear()
-    await asyncio.sleep(1)
-  
+      programme_handler._release_waiters()
+      try:
+        # the c lib waits for the removal of the service, so run it outside of the event loop
+        await self._caller_loop.run_in_executor(None, c_lib.unsubscribe_program, self.c_impl, program_pid)
+      finally:
+        # the c lib completes the removal even if the caller gets cancelled,
+        # so always arm the release once the last program is gone
+        if not self._programme_handlers:
+          self._schedule_channel_release(RadioController.CHANNEL_RESET_DELAY)
+
+  # releases the channel in a separate task, which subscribers can cancel until it holds the subscription lock
+  def _schedule_channel_release(self, delay=0):
+    self._channel_release = self._caller_loop.create_task(self._release_channel(delay))
+
+  async def _release_channel(self, delay):
+    await asyncio.sleep(delay)
+    async with self._subscription_lock:
+      self._channel_release = None
+      await self._reset_channel()
+
+  # callers need to hold the subscription lock.
+  # The release completes even if the caller gets cancelled, and the next subscriber waits for it
+  async def _reset_channel(self):
+    if not self._device_release:
+      # forget the channel right away, so the c lib callbacks stop using it
+      self._channel = RadioController.ChannelData()
+      self.programs.clear()
+      self._name_to_sid.clear()
+      self._device_release = self._caller_loop.create_task(self._release_device())
+    await asyncio.shield(self._device_release)
+
+  async def _release_device(self):
+    tuning = self._tuning
+    self._tuning = None
+    if tuning:
+      # the device can only get released once it is tuned
+      await asyncio.wait((tuning,))
+    # releasing the device blocks until its threads are stopped, so run it outside of the event loop
+    await self._caller_loop.run_in_executor(None, c_lib.set_channel, self.c_impl, "")
+    # the next tune waits for the device to settle, counted from here
+    self._channel_released_at = time.monotonic()
+    self._device_release = None
+
   async def finalize(self):
-    active_pids = list(self._programme_handlers.keys())
-    for program_pid in active_pids:
-      await self._unsubscribe(program_pid)
+    # wait for subscription changes in progress, so the c lib does not end a subscription twice
+    async with self._subscription_lock:
+      # release all consumers at once. The channel reset also ends their subscriptions in the c lib
+      for programme_handler in self._programme_handlers.values():
+        programme_handler._release_waiters()
+      self._programme_handlers.clear()
+      if self._channel_release:
+        self._channel_release.cancel()
+        self._channel_release = None
+      # the device gets closed anyway, so there is no need to let it settle.
+      # A tuned channel implies a subscription, which cached the event loop
+      if self._channel.name or self._device_release:
+        await self._reset_channel()
     c_lib.close_device(self.c_impl)
     c_lib.finalize(self.c_impl)
     
@@ -12,7 +12,7 @@ extern "C" {
 	PyObject* unsubscribe_program (PyObject *self, PyObject *args);
 	PyObject* stop_device		      (PyObject *self, PyObject *args);
 	PyObject* finalize		        (PyObject *self, PyObject *args);
-	PyObject* get_service_name		(PyObject *self, PyObject *args);
+	PyObject* get_service_names		(PyObject *self, PyObject *args);
 	PyObject* PyInit_libwelle_py	(void);
 }
 
@@ -21,20 +21,34 @@ class WavProgrammeHandler: public ProgrammeHandlerInterface {
 	PyObject_HEAD
 
 	protected:
-		ThreadPool pool;
+		std::unique_ptr<ThreadPool> pool;
+		// bound methods of the python handler, resolved once instead of on every callback
+		PyObject* on_new_audio;
+		PyObject* on_new_dynamic_label;
+		PyObject* on_mot;
 	public:
 		PyObject* python_impl;
 
-		WavProgrammeHandler(PyObject* pythonObj): pool(1)
+		WavProgrammeHandler(PyObject* pythonObj): pool(new ThreadPool(1))
 		{
 			std::cout << "Creating WavProgrammeHandler in C" << std::endl;
 			this->python_impl = pythonObj;
 			Py_XINCREF (python_impl);
+			on_new_audio         = PyObject_GetAttrString(python_impl, "onNewAudio");
+			on_new_dynamic_label = PyObject_GetAttrString(python_impl, "onNewDynamicLabel");
+			on_mot               = PyObject_GetAttrString(python_impl, "onMOT");
 		}
 
 		virtual ~WavProgrammeHandler() 
 		{
+			// let the pending callbacks complete before the python objects get released
+			pool.reset();
+			PyGILState_STATE gstate	= PyGILState_Ensure ();
+			Py_XDECREF (on_new_audio);
+			Py_XDECREF (on_new_dynamic_label);
+			Py_XDECREF (on_mot);
 			Py_XDECREF (python_impl);
+			PyGILState_Release (gstate);
 		}
 		
 		WavProgrammeHandler           (const WavProgrammeHandler& other)  = delete;
@@ -44,7 +58,7 @@ class WavProgrammeHandler: public ProgrammeHandlerInterface {
 
 		virtual void onFrameErrors(int frameErrors) override
 		{
-//      pool.enqueue([frameErrors, this]
+//      pool->enqueue([frameErrors, this]
 //      {
 //				PyGILState_STATE gstate	= PyGILState_Ensure ();
 //				PyObject *result = PyObject_CallMethod (python_impl, "onFrameErrors", "(i)", frameErrors);
@@ -57,12 +71,13 @@ class WavProgrammeHandler: public ProgrammeHandlerInterface {
 		
 		virtual void onNewAudio(std::vector<int16_t>&& audioData, int sampleRate, const std::string& mode) override
 		{
-      pool.enqueue([audioData, sampleRate, mode, this]
+      // move the decoded samples into the task instead of copying them
+      pool->enqueue([audioData = std::move(audioData), sampleRate, mode, this]
       {
 				PyGILState_STATE gstate	= PyGILState_Ensure ();
 				PyObject* data = PyBytes_FromStringAndSize((const char*)audioData.data(), 2*audioData.size());
-				PyObject *result = PyObject_CallMethod (python_impl, "onNewAudio", "(Nis)", data,
-																								sampleRate, mode.c_str());
+				PyObject *result = PyObject_CallFunction (on_new_audio, "(Nis)", data,
+																								  sampleRate, mode.c_str());
 				if (result)
 					 Py_DECREF (result);
 				PyGILState_Release (gstate);
@@ -71,7 +86,7 @@ class WavProgrammeHandler: public ProgrammeHandlerInterface {
 
 		virtual void onRsErrors(bool uncorrectedErrors, int numCorrectedErrors) override 
 		{
-//      pool.enqueue([uncorrectedErrors, numCorrectedErrors, this]
+//      pool->enqueue([uncorrectedErrors, numCorrectedErrors, this]
 //      {
 //				PyGILState_STATE gstate	= PyGILState_Ensure ();
 //				PyObject *result = PyObject_CallMethod (python_impl, "onRsErrors", "(bi)", uncorrectedErrors, numCorrectedErrors);
@@ -84,7 +99,7 @@ class WavProgrammeHandler: public ProgrammeHandlerInterface {
 		
 		virtual void onAacErrors(int aacErrors) override 
 		{ 
-//      pool.enqueue([aacErrors, this]
+//      pool->enqueue([aacErrors, this]
 //      {
 //				PyGILState_STATE gstate	= PyGILState_Ensure ();
 //				PyObject *result = PyObject_CallMethod (python_impl, "onAacErrors", "(i)", aacErrors);
@@ -97,10 +112,10 @@ class WavProgrammeHandler: public ProgrammeHandlerInterface {
 		
 		virtual void onNewDynamicLabel(const std::string& label) override
 		{
-      pool.enqueue([label, this]
+      pool->enqueue([label, this]
       {
 				PyGILState_STATE gstate	= PyGILState_Ensure ();
-				PyObject *result = PyObject_CallMethod (python_impl, "onNewDynamicLabel", "(s)", label.c_str());
+				PyObject *result = PyObject_CallFunction (on_new_dynamic_label, "(s)", label.c_str());
 
 				if (result)
 					Py_DECREF (result);
@@ -119,12 +134,12 @@ class WavProgrammeHandler: public ProgrammeHandlerInterface {
 				case 0x03: mime_type = "image/png";  break;
 				default:   mime_type = "unknown";
 			}
-      pool.enqueue([mime_type, mot_file, this]
+      pool->enqueue([mime_type, mot_file, this]
       {
 				PyGILState_STATE gstate	= PyGILState_Ensure ();
 				PyObject* data = PyBytes_FromStringAndSize((const char*)mot_file.data.data(), mot_file.data.size());
-				PyObject *result = PyObject_CallMethod (python_impl, "onMOT", "(Nss)", data,
-																								mime_type.c_str(), mot_file.content_name.c_str());
+				PyObject *result = PyObject_CallFunction (on_mot, "(Nss)", data,
+																								  mime_type.c_str(), mot_file.content_name.c_str());
 				if (result != NULL)
 					Py_DECREF (result);
 				PyGILState_Release (gstate);
@@ -147,6 +162,11 @@ class PythonRadioController : public RadioControllerInterface {
 	public:
 		bool synced = false;
 		PyObject* python_impl = nullptr;
+		// bound methods of the python controller, resolved once instead of on every callback
+		PyObject* on_sync_change        = nullptr;
+		PyObject* on_service_detected   = nullptr;
+		PyObject* on_new_ensemble       = nullptr;
+		PyObject* on_set_ensemble_label = nullptr;
 		CVirtualInput* device = nullptr;
 		std::map<uint32_t, WavProgrammeHandler*> programme_handlers;
 
@@ -159,6 +179,10 @@ class PythonRadioController : public RadioControllerInterface {
 			}
 			this->python_impl = pythonObj;
 			Py_XINCREF (python_impl);
+			on_sync_change        = PyObject_GetAttrString(python_impl, "onSyncChange");
+			on_service_detected   = PyObject_GetAttrString(python_impl, "onServiceDetected");
+			on_new_ensemble       = PyObject_GetAttrString(python_impl, "onNewEnsemble");
+			on_set_ensemble_label = PyObject_GetAttrString(python_impl, "onSetEnsembleLabel");
 
 			if (gain == -1) {
 					device->setAgc(true);
@@ -170,12 +194,17 @@ class PythonRadioController : public RadioControllerInterface {
 
 		virtual ~PythonRadioController() 
 		{
+			Py_XDECREF (on_sync_change);
+			Py_XDECREF (on_service_detected);
+			Py_XDECREF (on_new_ensemble);
+			Py_XDECREF (on_set_ensemble_label);
 			Py_XDECREF (python_impl);
 		}
 		
-		virtual void close_device() 
+		// the returned future completes once the callbacks queued before have run and the device is closed
+		virtual std::future<void> close_device() 
 		{
-			pool.enqueue([this]
+			return pool.enqueue([this]
 			{
 				if (device)
 				{
@@ -191,9 +220,18 @@ class PythonRadioController : public RadioControllerInterface {
 			{
 				if (rx)
 				{
-  				device->stop();
-          delete rx;
-          rx = nullptr;
+					// run the teardown on the pool, which also ends subscriptions.
+					// This keeps the receiver and the handler map from being released while a queued unsubscription uses them
+					pool.enqueue([this]
+					{
+						device->stop();
+						delete rx;
+						rx = nullptr;
+						// the receiver is gone, so release the handlers of the subscriptions which were not ended before
+						for (auto& entry : programme_handlers)
+							delete entry.second;
+						programme_handlers.clear();
+					}).wait();
 				}
 				return true;
 			}
@@ -227,19 +265,25 @@ class PythonRadioController : public RadioControllerInterface {
 			else
 			{
 				WavProgrammeHandler* c_handler = new WavProgrammeHandler(python_handler);
-				programme_handlers.emplace(sId, c_handler);
 				Service sadd = rx->getService(sId);
-				return rx->addServiceToDecode(*c_handler, "", sadd);
+				if (!rx->addServiceToDecode(*c_handler, "", sadd))
+				{
+					delete c_handler;
+					return false;
+				}
+				programme_handlers.emplace(sId, c_handler);
+				return true;
 			}
 		}
 
-		virtual bool unsubscribe_program(uint32_t sId)
+		// the returned future completes once the service is removed and its handler is deleted
+		virtual std::future<void> unsubscribe_program(uint32_t sId)
 		{
 			if (!rx)
-				return false;
+				return std::future<void>();
 			else
 			{
-				pool.enqueue([sId, this]
+				return pool.enqueue([sId, this]
 				{
 					Service sremove = rx->getService(sId);
 					rx->removeServiceToDecode(sremove);
@@ -249,20 +293,26 @@ class PythonRadioController : public RadioControllerInterface {
 					delete handler;
 				});
 			}
-			return true;
 		}
 
-		virtual PyObject* get_service_name(uint32_t sId)
+		// resolves the names of all given service ids at once. Unknown services get an empty name
+		virtual PyObject* get_service_names(PyObject* sId_list)
 		{
-      Service srv = rx->getService(sId);
-      if (srv.serviceId != 0) 
-      {
-        std::string label = srv.serviceLabel.utf8_label();
-        PyObject* label_py = PyUnicode_FromString(label.c_str());
-        return Py_NewRef(label_py);
-      }
-      else
-        return Py_NewRef(Py_None);
+			Py_ssize_t count = PyList_Size(sId_list);
+			PyObject* names_py = PyList_New(count);
+			for (Py_ssize_t i = 0; i < count; i++)
+			{
+				std::string label;
+				if (rx)
+				{
+					uint32_t sId = PyLong_AsUnsignedLong(PyList_GetItem(sId_list, i));
+					Service srv = rx->getService(sId);
+					if (srv.serviceId != 0)
+						label = srv.serviceLabel.utf8_label();
+				}
+				PyList_SET_ITEM(names_py, i, PyUnicode_FromString(label.c_str()));
+			}
+			return names_py;
 		}
 
 		virtual void onSNR(float snr) override
@@ -297,7 +347,7 @@ class PythonRadioController : public RadioControllerInterface {
       {
 				synced = isSync;
 				PyGILState_STATE gstate	= PyGILState_Ensure ();
-				PyObject *result = PyObject_CallMethod (python_impl, "onSyncChange", "(c)", isSync);
+				PyObject *result = PyObject_CallFunction (on_sync_change, "(c)", isSync);
 
 				if (result)
 					 Py_DECREF (result);
@@ -322,7 +372,7 @@ class PythonRadioController : public RadioControllerInterface {
       pool.enqueue([sId, this]
       {
         PyGILState_STATE gstate	= PyGILState_Ensure ();
-        PyObject *result = PyObject_CallMethod (python_impl, "onServiceDetected", "(k)", sId);
+        PyObject *result = PyObject_CallFunction (on_service_detected, "(k)", sId);
 
         if (result)
            Py_DECREF (result);
@@ -335,7 +385,7 @@ class PythonRadioController : public RadioControllerInterface {
       pool.enqueue([eId, this]
       {
 				PyGILState_STATE gstate	= PyGILState_Ensure ();
-				PyObject *result = PyObject_CallMethod (python_impl, "onNewEnsemble", "(I)", eId);
+				PyObject *result = PyObject_CallFunction (on_new_ensemble, "(I)", eId);
 
 				if (result)
 					 Py_DECREF (result);
@@ -348,7 +398,7 @@ class PythonRadioController : public RadioControllerInterface {
       pool.enqueue([label, this]
       {
 				PyGILState_STATE gstate	= PyGILState_Ensure ();
-				PyObject *result = PyObject_CallMethod (python_impl, "onSetEnsembleLabel", "(s)", label.utf8_label().c_str());
+				PyObject *result = PyObject_CallFunction (on_set_ensemble_label, "(s)", label.utf8_label().c_str());
 
 				if (result)
 					Py_DECREF (result);
@@ -448,7 +498,11 @@ PyObject *set_channel (PyObject */*self*/, PyObject *args)
 	PythonRadioController* ri = reinterpret_cast<PythonRadioController*>(PyCapsule_GetPointer (handle_capsule, "library_object"));
 	
   std::string channel(chan);
-	bool chan_ok = ri->set_channel(channel);
+	bool chan_ok;
+	// tuning the device does not touch python objects, so let other python threads run meanwhile
+	Py_BEGIN_ALLOW_THREADS
+	chan_ok = ri->set_channel(channel);
+	Py_END_ALLOW_THREADS
 	return chan_ok ? Py_NewRef(Py_True) : Py_NewRef(Py_False);
 }
 
@@ -465,15 +519,16 @@ PyObject *subscribe_program (PyObject */*self*/, PyObject *args)
 	return subscribe_ok ? Py_NewRef(Py_True) : Py_NewRef(Py_False);
 }
 
-PyObject *get_service_name (PyObject */*self*/, PyObject *args)
+PyObject *get_service_names (PyObject */*self*/, PyObject *args)
 {
 	PyObject	*handle_capsule;
-	uint32_t sId;
+	PyObject	*sId_list;
 
-	PyArg_ParseTuple (args, "OI", &handle_capsule, &sId);
+	if (!PyArg_ParseTuple (args, "OO!", &handle_capsule, &PyList_Type, &sId_list))
+		return NULL;
 	PythonRadioController* ri = reinterpret_cast<PythonRadioController*>(PyCapsule_GetPointer (handle_capsule, "library_object"));
 
-  return ri->get_service_name(sId);
+  return ri->get_service_names(sId_list);
 }
 
 PyObject *unsubscribe_program (PyObject */*self*/, PyObject *args) {
@@ -483,7 +538,15 @@ PyObject *unsubscribe_program (PyObject */*self*/, PyObject *args) {
 	PyArg_ParseTuple (args, "OI", &handle_capsule, &sId);
 	PythonRadioController* ri = reinterpret_cast<PythonRadioController*>(PyCapsule_GetPointer (handle_capsule, "library_object"));
 
-  bool unsubscribe_ok = ri->unsubscribe_program(sId);
+	std::future<void> unsubscribed = ri->unsubscribe_program(sId);
+	bool unsubscribe_ok = unsubscribed.valid();
+	if (unsubscribe_ok)
+	{
+		// the handler callbacks still pending need the GIL to complete
+		Py_BEGIN_ALLOW_THREADS
+		unsubscribed.wait();
+		Py_END_ALLOW_THREADS
+	}
 	return unsubscribe_ok ? Py_NewRef(Py_True) : Py_NewRef(Py_False);
 }
 
@@ -493,7 +556,11 @@ PyObject *close_device (PyObject */*self*/, PyObject *args) {
 	PyArg_ParseTuple (args, "O", &handle_capsule);
 	PythonRadioController* ri = reinterpret_cast<PythonRadioController*>(PyCapsule_GetPointer (handle_capsule, "library_object"));
 
-	ri->close_device();
+	std::future<void> closed = ri->close_device();
+	// the pending callbacks need the GIL to complete
+	Py_BEGIN_ALLOW_THREADS
+	closed.wait();
+	Py_END_ALLOW_THREADS
 	Py_RETURN_NONE;
 }
 
@@ -514,7 +581,7 @@ static PyMethodDef module_methods [] = {
 	{"unsubscribe_program",	unsubscribe_program, METH_VARARGS, ""},
 	{"close_device",        close_device,        METH_VARARGS, ""},
 	{"finalize",            finalize,            METH_VARARGS, ""},
-	{"get_service_name",    get_service_name,    METH_VARARGS, ""},
+	{"get_service_names",   get_service_names,   METH_VARARGS, ""},
 	{NULL, NULL, 0, NULL}
 };
 